@@ -1,16 +1,25 @@
 import os
 import io
+import asyncio
 import re
+import string
+import math
+import hashlib
 import uuid
 import json
 import sqlite3
 import logging
-import random
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime
 from typing import Optional
 
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, Response
 from fastapi.staticfiles import StaticFiles
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -23,15 +32,43 @@ from telegram.ext import (
     ContextTypes,
 )
 
-from PIL import Image
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+import numpy as np
+from cachetools import LRUCache, TTLCache
+from PIL import Image, ImageChops, ImageFilter, __version__ as PIL_VERSION
 import pytesseract
 
+# Must be set before Tesseract loads: parallelism comes from concurrent uploads,
+# and OpenMP threads inside a single recognition call only contend with them.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+try:
+    from tesserocr import OEM, PSM, PyTessBaseAPI, get_languages
+except ImportError:
+    PyTessBaseAPI = None
+
 # ---------- Config ----------
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 # e.g. https://rizo-battle-bot.onrender.com. Used to construct the WEBHOOK_URL.
 RENDER_EXTERNAL_URL = os.getenv("RENDER_EXTERNAL_URL")  
 # Reads the PORT environment variable provided by Render, defaults to 10000.
 PORT = int(os.getenv("PORT", 10000)) 
+# "2" multiplexes Bot API calls and file downloads over one connection; PTB
+# reports h2 keep-alive instability, so HTTP/1.1 stays the default.
+TELEGRAM_HTTP_VERSION = os.getenv("TELEGRAM_HTTP_VERSION", "1.1")
+# Challenges and uploaded cards that never meet their match expire after this many seconds
+STATE_TTL = int(os.getenv("STATE_TTL", 3600))
+STATE_MAX_ENTRIES = 10_000
+# Shared store for challenges and cards; required when running more than one uvicorn worker
+REDIS_URL = os.getenv("REDIS_URL")
 
 if not BOT_TOKEN or not RENDER_EXTERNAL_URL:
     # Use log.error instead of raising for cleaner shutdown context
@@ -42,6 +79,19 @@ WEBHOOK_PATH = "/telegram-hook"
 WEBHOOK_URL = f"{RENDER_EXTERNAL_URL}{WEBHOOK_PATH}"
 # --------------------------------------------------------
 
+# ---------- JSON ----------
+# orjson parses/serializes several times faster than stdlib json; keep the
+# stdlib as a fallback so the bot still runs without it.
+def json_loads(data: bytes):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def json_dumps(obj) -> str:
+    return orjson.dumps(obj).decode() if orjson else json.dumps(obj)
+
+def json_dumpb(obj) -> bytes:
+    # For sinks that take bytes as-is (SQLite BLOBs); skips orjson's str decode
+    return orjson.dumps(obj) if orjson else json.dumps(obj).encode()
+
 # ---------- Logging ----------
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("rizo-battle-bot")
@@ -51,65 +101,499 @@ app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # ---------- Storage ----------
-os.makedirs("battles", exist_ok=True)
-os.makedirs("cards", exist_ok=True)
+# Created once here; handlers build paths under them without re-checking
+BATTLES_DIR = "battles"
+CARDS_DIR = "cards"
+for _dir in (BATTLES_DIR, CARDS_DIR):
+    os.makedirs(_dir, exist_ok=True)
 DB_PATH = "battles.db"
 
+# One long-lived connection shared by all handlers. Autocommit mode
+# (isolation_level=None) plus WAL keeps each write to a journal append instead
+# of a full fsync; _DB_LOCK serializes writers across threads.
+DB = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+_DB_LOCK = threading.Lock()
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        """
-        CREATE TABLE IF NOT EXISTS battles (
-            id TEXT PRIMARY KEY,
-            timestamp TEXT,
-            challenger_username TEXT,
-            challenger_stats TEXT,
-            opponent_username TEXT,
-            opponent_stats TEXT,
-            winner TEXT,
-            html_path TEXT
+    with _DB_LOCK:
+        DB.execute("PRAGMA journal_mode=WAL")
+        DB.execute("PRAGMA synchronous=NORMAL")
+        DB.execute("PRAGMA busy_timeout=5000")
+        DB.execute("PRAGMA temp_store=MEMORY")
+        DB.execute(
+            """
+            CREATE TABLE IF NOT EXISTS battles (
+                id TEXT PRIMARY KEY,
+                timestamp TEXT,
+                challenger_username TEXT,
+                challenger_stats BLOB,
+                opponent_username TEXT,
+                opponent_stats BLOB,
+                winner TEXT,
+                html_path TEXT
+            )
+            """
         )
-        """
-    )
-    conn.commit()
-    conn.close()
+        DB.execute("CREATE INDEX IF NOT EXISTS idx_battles_ts ON battles(timestamp)")
 
 init_db()
 
+def close_db():
+    with _DB_LOCK:
+        # Refresh query-planner stats for the index on the way out, as SQLite recommends
+        DB.execute("PRAGMA optimize")
+        DB.close()
+
+# Reusing the exact SQL text lets sqlite3's statement cache skip re-preparing it
+_INSERT_SQL = (
+    "INSERT INTO battles (id,timestamp,challenger_username,challenger_stats,opponent_username,opponent_stats,winner,html_path) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+@contextmanager
+def tx():
+    """Run the enclosed writes in one BEGIN IMMEDIATE ... COMMIT transaction."""
+    with _DB_LOCK:
+        DB.execute("BEGIN IMMEDIATE")
+        try:
+            yield DB
+        except BaseException:
+            DB.execute("ROLLBACK")
+            raise
+        DB.execute("COMMIT")
+
 # ---------- Runtime state ----------
-pending_challenges: dict[int, str] = {}  # challenger_id -> opponent_username
-uploaded_cards: dict[int, dict] = {}      # user_id -> card info
+# TTL-bounded so abandoned challenges and cards don't accumulate for the life of the process
+pending_challenges: TTLCache[int, str] = TTLCache(STATE_MAX_ENTRIES, STATE_TTL)  # challenger_id -> opponent_username
+uploaded_cards: TTLCache[int, dict] = TTLCache(STATE_MAX_ENTRIES, STATE_TTL)     # user_id -> card info
+# Reverse indices so matching an upload to a challenge never scans the dicts above.
+# They expire on the same schedule, but may briefly outlive an entry above, so
+# lookups through them are always confirmed against the primary dicts.
+_cards_by_username: TTLCache[str, int] = TTLCache(STATE_MAX_ENTRIES, STATE_TTL)         # username -> user_id
+_challenges_by_target: TTLCache[str, set[int]] = TTLCache(STATE_MAX_ENTRIES, STATE_TTL)  # opponent_username -> challenger_ids
+
+def register_challenge(challenger_id: int, opponent_username: str):
+    remove_challenge(challenger_id)
+    pending_challenges[challenger_id] = opponent_username
+    challengers = _challenges_by_target.get(opponent_username, set())
+    challengers.add(challenger_id)
+    _challenges_by_target[opponent_username] = challengers  # Reassign to restart its TTL
+
+def remove_challenge(challenger_id: int):
+    opponent_username = pending_challenges.pop(challenger_id, None)
+    challengers = _challenges_by_target.get(opponent_username)
+    if challengers is not None:
+        challengers.discard(challenger_id)
+        if not challengers:
+            del _challenges_by_target[opponent_username]
+
+def register_card(card: dict):
+    remove_card(card["user_id"])
+    uploaded_cards[card["user_id"]] = card
+    _cards_by_username[card["username"]] = card["user_id"]
+
+def remove_card(user_id: int):
+    card = uploaded_cards.pop(user_id, None)
+    if card is not None and _cards_by_username.get(card["username"]) == user_id:
+        del _cards_by_username[card["username"]]
+
+def find_battle_pair(user_id: int, username: str) -> Optional[tuple[int, int]]:
+    """Return (challenger_id, opponent_id) once both sides have uploaded a card."""
+    # Case 1: Challenger uploads card after challenging
+    opp_name = pending_challenges.get(user_id)
+    if opp_name is not None:
+        opp_id = _cards_by_username.get(opp_name)
+        if opp_id and opp_id != user_id and opp_id in uploaded_cards: # Ensure user isn't challenging/fighting self
+            return (user_id, opp_id)
+    # Case 2: Opponent uploads card matching an existing challenge
+    for challenger_id in _challenges_by_target.get(username, ()):
+        if (challenger_id in uploaded_cards and challenger_id != user_id
+                and pending_challenges.get(challenger_id) == username):
+            return (challenger_id, user_id)
+    return None
+
+# ---------- Shared state (Redis) ----------
+# With several uvicorn workers a challenge and the matching upload can land in
+# different processes, so REDIS_URL moves the state above into Redis (JSON
+# values, STATE_TTL expiry). Without it the in-process maps are used and the app
+# must run as a single worker.
+_redis = None
+if REDIS_URL:
+    if aioredis is None:
+        logging.error("REDIS_URL is set but the redis package is missing; using in-process state.")
+    else:
+        _redis = aioredis.from_url(REDIS_URL, decode_responses=True)
+if _redis is None and int(os.getenv("WEB_CONCURRENCY", 1)) > 1:
+    logging.error("WEB_CONCURRENCY > 1 without Redis: each worker keeps its own challenges and cards, "
+                  "so a challenge and the matching upload may never meet. Set REDIS_URL.")
+
+def _challenge_key(challenger_id: int) -> str: return f"rizo:challenge:{challenger_id}"
+def _challengers_key(username: str) -> str: return f"rizo:challengers:{username}"
+def _card_key(user_id: int) -> str: return f"rizo:card:{user_id}"
+def _card_owner_key(username: str) -> str: return f"rizo:card_owner:{username}"
+
+async def store_challenge(challenger_id: int, opponent_username: str):
+    if _redis is None:
+        register_challenge(challenger_id, opponent_username)
+        return
+    old_target = await _redis.set(_challenge_key(challenger_id), opponent_username, ex=STATE_TTL, get=True)
+    async with _redis.pipeline(transaction=True) as pipe:
+        if old_target and old_target != opponent_username:
+            pipe.srem(_challengers_key(old_target), challenger_id)
+        pipe.sadd(_challengers_key(opponent_username), challenger_id)
+        pipe.expire(_challengers_key(opponent_username), STATE_TTL)
+        await pipe.execute()
+
+async def store_card(card: dict):
+    if _redis is None:
+        register_card(card)
+        return
+    async with _redis.pipeline(transaction=True) as pipe:
+        pipe.set(_card_key(card["user_id"]), json_dumps(card), ex=STATE_TTL)
+        pipe.set(_card_owner_key(card["username"]), card["user_id"], ex=STATE_TTL)
+        await pipe.execute()
+
+async def _redis_battle_pair(user_id: int, username: str) -> Optional[tuple[int, int]]:
+    # Same two cases as find_battle_pair, confirmed against the primary keys
+    opp_name = await _redis.get(_challenge_key(user_id))
+    if opp_name is not None:
+        opp_id = await _redis.get(_card_owner_key(opp_name))
+        if opp_id and int(opp_id) != user_id and await _redis.exists(_card_key(int(opp_id))):
+            return (user_id, int(opp_id))
+    for challenger_id in map(int, await _redis.smembers(_challengers_key(username))):
+        if (challenger_id != user_id and await _redis.exists(_card_key(challenger_id))
+                and await _redis.get(_challenge_key(challenger_id)) == username):
+            return (challenger_id, user_id)
+    return None
+
+async def claim_battle(user_id: int, username: str) -> Optional[tuple[dict, dict]]:
+    """Find a ready (challenger, opponent) pair for this upload and remove both
+    cards and the challenge, so exactly one caller gets to run the battle."""
+    if _redis is None:
+        pair = find_battle_pair(user_id, username)
+        if not pair:
+            return None
+        c1_id, c2_id = pair
+        card1, card2 = uploaded_cards[c1_id], uploaded_cards[c2_id]
+        remove_card(c1_id)
+        remove_card(c2_id)
+        remove_challenge(c1_id)
+        # A mutual challenge is settled by this battle too
+        if pending_challenges.get(c2_id) == card1["username"]:
+            remove_challenge(c2_id)
+        return card1, card2
+
+    pair = await _redis_battle_pair(user_id, username)
+    if not pair:
+        return None
+    c1_id, c2_id = pair
+    # GETDEL inside MULTI is atomic across workers: only one sees both cards
+    async with _redis.pipeline(transaction=True) as pipe:
+        pipe.getdel(_card_key(c1_id))
+        pipe.getdel(_card_key(c2_id))
+        raw1, raw2 = (await pipe.execute())[:2]
+    if raw1 is None or raw2 is None:
+        # Lost the race (or a card expired); put back whatever we took
+        for raw in (raw1, raw2):
+            if raw is not None:
+                card = json_loads(raw)
+                await _redis.set(_card_key(card["user_id"]), raw, ex=STATE_TTL)
+        return None
+    card1, card2 = json_loads(raw1), json_loads(raw2)
+    opp_name = await _redis.getdel(_challenge_key(c1_id))
+    # A mutual challenge is settled by this battle too
+    mutual = await _redis.get(_challenge_key(c2_id)) == card1["username"]
+    async with _redis.pipeline(transaction=True) as pipe:
+        if opp_name:
+            pipe.srem(_challengers_key(opp_name), c1_id)
+        if mutual:
+            pipe.delete(_challenge_key(c2_id))
+            pipe.srem(_challengers_key(card1["username"]), c2_id)
+        for card in (card1, card2):
+            pipe.delete(_card_owner_key(card["username"]))
+        await pipe.execute()
+    return card1, card2
+
+# Serializes each user's uploads (they share cards/<username>.png) without
+# making unrelated users wait on one another. Entries are refcounted and
+# dropped once nobody holds or waits on them, so the dict stays small.
+_state_locks: dict[int, list] = {}  # user_id -> [lock, holders + waiters]
+
+@asynccontextmanager
+async def user_state_lock(user_id: int):
+    entry = _state_locks.setdefault(user_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _state_locks[user_id]
 
 # ---------- OCR helpers ----------
-def ocr_text_from_bytes(file_bytes: bytes) -> str:
-    image = Image.open(io.BytesIO(file_bytes)).convert("RGB")
-    return pytesseract.image_to_string(image)
+def _tesserocr_enabled() -> bool:
+    # A persistent engine skips the per-call CLI fork and LSTM model load that
+    # pytesseract pays; fall back to pytesseract if tesserocr is unavailable.
+    if PyTessBaseAPI is None:
+        return False
+    path, languages = get_languages()
+    if "eng" not in languages:
+        log.warning(f"tesserocr has no 'eng' data in {path!r}, falling back to pytesseract.")
+        return False
+    return True
+
+TESSEROCR_ENABLED = _tesserocr_enabled()
+
+# Tesseract releases the GIL while recognising (and pytesseract runs it as a
+# subprocess), so worker threads, each holding its own engine, OCR independent
+# uploads in parallel. With OMP_THREAD_LIMIT=1, one worker per core.
+# OCR_POOL=process moves the GIL-bound image decode/threshold into worker
+# processes too, at the cost of pickling results and a process per worker.
+# Every worker holds a loaded engine (tens of MB), so the default counts only
+# the cores this container may use and is capped; set OCR_WORKERS to go higher.
+OCR_WORKERS_DEFAULT_MAX = 4
+
+def _available_cpus() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", min(_available_cpus(), OCR_WORKERS_DEFAULT_MAX)))
+OCR_POOL_KIND = os.getenv("OCR_POOL", "thread")
+_tess_local = threading.local()
+
+def _tess_api():
+    api = getattr(_tess_local, "api", None)
+    if api is None:
+        api = _tess_local.api = PyTessBaseAPI(lang="eng", psm=PSM.SINGLE_BLOCK, oem=OEM.LSTM_ONLY)
+    return api
+
+def _init_ocr_process():
+    if TESSEROCR_ENABLED:
+        _tess_api()
+
+if OCR_POOL_KIND == "process":
+    _OCR_POOL = ProcessPoolExecutor(max_workers=OCR_WORKERS, initializer=_init_ocr_process)
+else:
+    _OCR_POOL = ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix="ocr")
+
+async def warm_ocr_engines():
+    """Load one engine per OCR worker thread up front, so the first uploads
+    after a deploy don't each pay Tesseract's model load."""
+    loop = asyncio.get_running_loop()
+    if OCR_POOL_KIND == "process":
+        # Forked workers all start on the first submit and load their engine
+        # in _init_ocr_process before taking jobs.
+        try:
+            await loop.run_in_executor(_OCR_POOL, int)
+        except Exception as e:
+            log.error(f"OCR process pool failed to start ({e!r}); card OCR will fail until restart.")
+        return
+    if not TESSEROCR_ENABLED:
+        return
+    # The barrier holds each warm-up job until all are running, which forces the
+    # pool to start every worker thread instead of reusing the first one.
+    barrier = threading.Barrier(OCR_WORKERS)
+    def warm():
+        try:
+            _tess_api()
+        except Exception:
+            # Release the workers already waiting instead of holding them until the timeout
+            barrier.abort()
+            raise
+        barrier.wait(timeout=30)
+    results = await asyncio.gather(*(loop.run_in_executor(_OCR_POOL, warm) for _ in range(OCR_WORKERS)),
+                                   return_exceptions=True)
+    # Report the engine failure itself, not the broken barrier it caused in the others
+    errors = [r for r in results if isinstance(r, Exception)]
+    if errors:
+        e = next((r for r in errors if not isinstance(r, threading.BrokenBarrierError)), errors[0])
+        log.warning(f"OCR engine warm-up failed: {e}")
+    else:
+        log.info(f"Warmed {OCR_WORKERS} tesserocr engine(s).")
+
+# LSTM engine only, and treat the card as one uniform block of text: skips the
+# legacy engine and most of Tesseract's page-layout analysis.
+TESSERACT_CONFIG = "--oem 1 --psm 6"
+
+# Card stats stay legible well below phone-camera resolution, and Tesseract's
+# work grows with pixel count; raise this for cards with unusually small print.
+OCR_MAX_EDGE = int(os.getenv("OCR_MAX_EDGE", 1200))
+
+OCR_THRESHOLD_BLOCK = 31  # Neighbourhood (pixels) the local mean is taken over
+OCR_THRESHOLD_C = 10
+_OCR_BLUR = ImageFilter.BoxBlur(OCR_THRESHOLD_BLOCK // 2)
+# Maps (local mean - pixel), clipped at 0, to black/white
+_OCR_THRESHOLD_LUT = [0 if d > OCR_THRESHOLD_C else 255 for d in range(256)]
+
+def prepare_ocr_image(image: Image.Image) -> Image.Image:
+    # Tesseract time scales with pixel count, and it works faster on binary input.
+    # For a freshly opened JPEG, draft() has libjpeg decode straight to grayscale at
+    # the smallest 1/2, 1/4 or 1/8 scale still covering OCR_MAX_EDGE; other formats ignore it.
+    image.draft("L", (OCR_MAX_EDGE, OCR_MAX_EDGE))
+    image = image.convert("L")
+    image.thumbnail((OCR_MAX_EDGE, OCR_MAX_EDGE), Image.Resampling.BILINEAR)
+    # Adaptive (local mean) threshold: a pixel turns black when it is more than
+    # OCR_THRESHOLD_C darker than its neighbourhood, so stats printed over card
+    # art and gradients survive where a single global threshold would lose them.
+    local_mean = image.filter(_OCR_BLUR)
+    return ImageChops.subtract(local_mean, image).point(_OCR_THRESHOLD_LUT)
+
+def ocr_text_from_path(path: str) -> str:
+    return ocr_text_from_image(Image.open(path))
+
+def ocr_text_from_image(image: Image.Image) -> str:
+    image = prepare_ocr_image(image)
+    if not TESSEROCR_ENABLED:
+        return pytesseract.image_to_string(image, config=TESSERACT_CONFIG)
+    api = _tess_api()
+    api.SetImage(image)
+    return api.GetUTF8Text()
+
+def ocr_text_batch(image_paths: list[str]) -> list[str]:
+    """OCR several cards with a single tesseract process (pytesseract fallback).
+
+    The tesseract CLI accepts a text file listing image paths and emits one
+    form-feed separated page per image, so the process startup and model load
+    are paid once per batch instead of once per card.
+    """
+    if len(image_paths) == 1:
+        return [ocr_text_from_path(image_paths[0])]
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for i, image_path in enumerate(image_paths):
+            path = os.path.join(tmp, f"{i}.png")
+            # Scratch file read once by tesseract: skip most of zlib's work
+            prepare_ocr_image(Image.open(image_path)).save(path, compress_level=1)
+            paths.append(path)
+        list_path = os.path.join(tmp, "images.txt")
+        with open(list_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(paths))
+        pages = pytesseract.image_to_string(list_path, config=TESSERACT_CONFIG).split("\f")
+    pages += [""] * (len(image_paths) - len(pages))
+    return pages[:len(image_paths)]
+
+OCR_BATCH_WINDOW = 0.1  # Seconds to gather concurrent uploads into one tesseract run
+_pending_ocr: list[tuple[str, asyncio.Future]] = []
+_ocr_tasks: set[asyncio.Task] = set()
+
+async def _flush_ocr_batch():
+    batch = _pending_ocr[:]
+    _pending_ocr.clear()
+    try:
+        loop = asyncio.get_running_loop()
+        stats = await loop.run_in_executor(_OCR_POOL, card_stats_batch, [path for path, _ in batch])
+    except Exception as e:
+        for _, fut in batch:
+            if not fut.done():
+                fut.set_exception(e)
+        return
+    # A waiter cancelled meanwhile has a done future; skip it so the rest still resolve
+    for (_, fut), card_stats in zip(batch, stats):
+        if not fut.done():
+            fut.set_result(card_stats)
+
+def _schedule_ocr_flush():
+    task = asyncio.create_task(_flush_ocr_batch())
+    _ocr_tasks.add(task)
+    task.add_done_callback(_ocr_tasks.discard)
+
+def card_stats_from_path(path: str) -> dict:
+    return card_stats_from_image(Image.open(path))
+
+def card_stats_from_image(image: Image.Image) -> dict:
+    return parse_stats_from_text(ocr_text_from_image(image))
+
+def card_stats_batch(image_paths: list[str]) -> list[dict]:
+    return [parse_stats_from_text(text) for text in ocr_text_batch(image_paths)]
+
+STATS_CACHE_SIZE = 1024
+# blake2b digest of the card file -> parsed stats, in LRU order. Re-uploads of
+# the same image (retries, re-challenges) skip OCR entirely.
+_STATS_CACHE: OrderedDict[bytes, dict] = OrderedDict()
+
+def save_card_file(path: str, data: memoryview) -> bytes:
+    """Write an uploaded card to disk and return its content digest.
+
+    Both steps read the download buffer in place (no bytes copy) and release
+    the GIL, so this runs in a worker thread.
+    """
+    with open(path, "wb") as f:
+        f.write(data)
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+async def read_card_stats(path: str, digest: bytes, data: io.BytesIO) -> dict:
+    """OCR and parse a saved card on the OCR pool, keeping the event loop free.
+
+    ``data`` is the downloaded file still in memory; worker threads decode it
+    directly instead of reading ``path`` back from disk.
+    """
+    stats = _STATS_CACHE.get(digest)
+    if stats is not None:
+        _STATS_CACHE.move_to_end(digest)
+    else:
+        stats = _STATS_CACHE[digest] = await _ocr_card_stats(path, data)
+        if len(_STATS_CACHE) > STATS_CACHE_SIZE:
+            _STATS_CACHE.popitem(last=False)
+    return dict(stats)
+
+async def _ocr_card_stats(path: str, data: io.BytesIO) -> dict:
+    # The persistent engine has no per-call startup to amortize, so only the
+    # pytesseract fallback queues uploads for a batched run.
+    loop = asyncio.get_running_loop()
+    if TESSEROCR_ENABLED:
+        if OCR_POOL_KIND == "process":
+            # A path pickles to the worker for free; the image buffer would be copied
+            return await loop.run_in_executor(_OCR_POOL, card_stats_from_path, path)
+        # Image.open only reads the header here; decoding happens on the worker
+        data.seek(0)
+        return await loop.run_in_executor(_OCR_POOL, card_stats_from_image, Image.open(data))
+    fut = loop.create_future()
+    _pending_ocr.append((path, fut))
+    if len(_pending_ocr) == 1:
+        loop.call_later(OCR_BATCH_WINDOW, _schedule_ocr_flush)
+    return await fut
+
+# HP, defense and serial are each the first match anywhere in the text, so a
+# label OCR glued to a preceding word ("MaxHP: 150") still counts. Move names
+# are up to ATTACK_NAME_WORDS whitespace-separated words anchored at a word
+# boundary (an unbounded [a-z\s]+ retried every suffix of long letter runs),
+# never swallow an "HP 120" / "Defense 40" stat, and the power may run
+# straight into a unit ("20dmg").
+ATTACK_NAME_WORDS = 4
+_DEF = r"defen(?:se|c)e?[:\s]*"
+_ATK_WORD = rf"(?!hp[:\s]*[0-9]|{_DEF}[0-9])[a-z]{{1,20}}"
+_STAT_RES = {
+    "hp": re.compile(r"hp[:\s]*([0-9]{1,4})", re.IGNORECASE),
+    "defense": re.compile(rf"{_DEF}([0-9]{{1,4}})", re.IGNORECASE),
+    "serial": re.compile(r"#\s*([0-9]{1,4})"),
+}
+_ATTACK_RE = re.compile(
+    rf"\b({_ATK_WORD}(?:\s+{_ATK_WORD}){{0,{ATTACK_NAME_WORDS - 1}}})"
+    rf"\s*[:\-]?\s*([0-9]{{1,4}})(?![0-9])",
+    re.IGNORECASE,
+)
+_ATK_KW_RE = re.compile(r"attack|move|strike|blast|slash|punch|kick", re.IGNORECASE)
+_STAT_DEFAULTS = {"hp": 100, "defense": 50, "serial": 1000}
 
 def parse_stats_from_text(text: str) -> dict:
-    lower = text.lower()
-    # HP
-    hp_match = re.search(r"hp[:\s]*([0-9]{1,4})", lower)
-    hp = int(hp_match.group(1)) if hp_match else 100
-    # Defense
-    defense_match = re.search(r"defen(?:se|c)e?[:\s]*([0-9]{1,4})", lower)
-    defense = int(defense_match.group(1)) if defense_match else 50
-    # Serial
-    serial_match = re.search(r"#\s*([0-9]{1,4})", text)
-    serial = int(serial_match.group(1)) if serial_match else 1000
-    # Attacks
-    attack_patterns = re.findall(r"([a-z\s]+)\s*[:\-]?\s*([0-9]{1,4})", text, re.IGNORECASE)
+    stats = {}
+    for kind, pattern in _STAT_RES.items():
+        m = pattern.search(text)
+        if m:
+            stats[kind] = int(m[1])
     attacks = []
-    for name, val in attack_patterns:
-        name = name.strip().title()
-        if any(k in name.lower() for k in ["attack", "move", "strike", "blast", "slash"]):
-            attacks.append((name, int(val)))
+    for m in _ATTACK_RE.finditer(text):
+        if _ATK_KW_RE.search(m[1]):
+            attacks.append((m[1].strip().title(), int(m[2])))
+            if len(attacks) == 2:
+                break
+    hp, defense, serial = (stats.get(k, v) for k, v in _STAT_DEFAULTS.items())
     if not attacks:
         attacks = [("Basic Strike", 30), ("Heavy Blow", 40)]
     elif len(attacks) == 1:
         attacks.append(("Heavy Blow", attacks[0][1] + 10))
-    else:
-        attacks = attacks[:2]
     return {
         "hp": hp,
         "defense": defense,
@@ -118,6 +602,9 @@ def parse_stats_from_text(text: str) -> dict:
         "attack1_power": attacks[0][1],
         "attack2_name": attacks[1][0],
         "attack2_power": attacks[1][1],
+        # Resolved once here so simulate_battle never re-scans move names per turn
+        "attack1_elem": element_id(attacks[0][0]),
+        "attack2_elem": element_id(attacks[1][0]),
     }
 
 # ---------- HP calculation ----------
@@ -134,127 +621,260 @@ ELEMENTAL_MODIFIERS = {
     "water": {"fire": 1.5, "earth": 1.0, "water": 1.0},
     "earth": {"fire": 1.0, "water": 1.0, "earth": 1.0},
 }
+# Cards carry element IDs (indexes into ELEMENTS) resolved once at parse time
+ELEMENTS = ("normal", "fire", "water", "earth")
+ELEM_NORMAL = 0
+_ELEM_IDX = {elem: i for i, elem in enumerate(ELEMENTS)}
+# ELEM_MOD[attacker_elem, defender_elem]; pairs missing above (and "normal") stay 1.0
+ELEM_MOD = np.ones((len(ELEMENTS), len(ELEMENTS)))
+for _atk, _row in ELEMENTAL_MODIFIERS.items():
+    for _dfn, _mod in _row.items():
+        ELEM_MOD[_ELEM_IDX[_atk], _ELEM_IDX[_dfn]] = _mod
 
-def get_element(move_name: str) -> str:
+def element_id(move_name: str) -> int:
     name = move_name.lower()
-    if "fire" in name: return "fire"
-    if "water" in name: return "water"
-    if "earth" in name: return "earth"
-    return "normal"
+    # First of fire, water, earth named in the move wins
+    return next((i for i, elem in enumerate(ELEMENTS) if i != ELEM_NORMAL and elem in name), ELEM_NORMAL)
+
+MAX_TURNS = 100  # Turn limit to prevent infinite loops
+MIN_DAMAGE = 5
+_RNG = np.random.default_rng()
+
+def max_battle_turns(hp1: int, hp2: int) -> int:
+    # Every hit deals at least MIN_DAMAGE, so card2 falls within ceil(hp2/5)
+    # of card1's (even) turns and card1 within ceil(hp1/5) of card2's (odd) ones.
+    return min(MAX_TURNS,
+               2 * math.ceil(hp2 / MIN_DAMAGE) - 1,
+               2 * math.ceil(hp1 / MIN_DAMAGE))
+
+def _attack_table(attacker: dict, defender: dict):
+    """Per-move (powers, modifiers, log labels) for attacker's two moves vs defender."""
+    # For simplicity, base element effectiveness on the opponent's first move element
+    mods = ELEM_MOD[[attacker["attack1_elem"], attacker["attack2_elem"]], defender["attack1_elem"]]
+    powers = np.array([attacker["attack1_power"], attacker["attack2_power"]], dtype=np.float64)
+    labels = [f"@{attacker['username']} used {attacker[f'attack{i + 1}_name']} ({int(mod*100)}% eff.)"
+              for i, mod in enumerate(mods.tolist())]
+    return powers, mods, labels
+
+def _roll_hits(powers: np.ndarray, mods: np.ndarray, defender_defense, n):
+    """Move picks and damage for an attacker's next n hits.
+
+    Works for one battle (powers/mods of shape (2,), n an int) or a batch
+    (powers/mods of shape (battles, 2), defender_defense (battles, 1), n a shape).
+    """
+    picks = _RNG.integers(0, 2, n)
+    if powers.ndim == 1:
+        raw_damage = powers[picks] * _RNG.uniform(0.8, 1.2, n) * mods[picks]
+    else:
+        raw_damage = (np.take_along_axis(powers, picks, axis=1) * _RNG.uniform(0.8, 1.2, n)
+                      * np.take_along_axis(mods, picks, axis=1))
+    dmg = (raw_damage - defender_defense * 0.1).astype(np.int64)
+    return picks, np.maximum(MIN_DAMAGE, dmg)
+
+def _battle_result(card1: dict, card2: dict, hp1: int, hp2: int, turns: int, side1, side2) -> dict:
+    """Build the result for the first `turns` turns; side = (labels, picks, dmg) for that card's hits."""
+    hits1, hits2 = (turns + 1) // 2, turns // 2
+    (labels1, picks1, dmg1), (labels2, picks2, dmg2) = side1, side2
+    dmg1, dmg2 = dmg1[:hits1].tolist(), dmg2[:hits2].tolist()
+    hp2 -= sum(dmg1)
+    hp1 -= sum(dmg2)
+
+    # The log is only built for turns that actually happened
+    battle_log = [None] * turns
+    battle_log[0::2] = [f"{labels1[p]} → {d} dmg!" for p, d in zip(picks1[:hits1].tolist(), dmg1)]
+    battle_log[1::2] = [f"{labels2[p]} → {d} dmg!" for p, d in zip(picks2[:hits2].tolist(), dmg2)]
+
+    winner = card1["username"] if hp1 > 0 else (card2["username"] if hp2 > 0 else None)
+    return {"winner": winner, "hp1_end": max(0, hp1), "hp2_end": max(0, hp2), "log": battle_log}
 
 def simulate_battle(card1: dict, card2: dict):
     hp1 = calculate_hp(card1)
     hp2 = calculate_hp(card2)
-    defense1 = card1["defense"]
-    defense2 = card2["defense"]
-    turn = 0
-    battle_log = []
-
-    while hp1 > 0 and hp2 > 0 and turn < 100: # Add turn limit to prevent infinite loops
-        attacker_card, defender_card = (card1, card2) if turn % 2 == 0 else (card2, card1)
-        attacker_hp_ref, defender_hp_ref = (hp1, hp2) if turn % 2 == 0 else (hp2, hp1)
-        defender_defense = defense2 if turn % 2 == 0 else defense1
-
-        move_name, move_power = random.choice([(attacker_card["attack1_name"], attacker_card["attack1_power"]),
-                                                (attacker_card["attack2_name"], attacker_card["attack2_power"])])
-        
-        elem1 = get_element(move_name)
-        # For simplicity, base element effectiveness on the opponent's first move element
-        elem2 = get_element(defender_card["attack1_name"]) 
-        modifier = ELEMENTAL_MODIFIERS.get(elem1, {}).get(elem2, 1.0)
-        
-        # Damage calculation logic
-        raw_damage = move_power * random.uniform(0.8, 1.2) * modifier
-        damage_reduction = defender_defense * 0.1
-        dmg = int(raw_damage - damage_reduction)
-        dmg = max(5, dmg) # Minimum damage is 5
-
-        # Update defender's HP
-        if turn % 2 == 0:
-            hp2 -= dmg
-        else:
-            hp1 -= dmg
-        
-        battle_log.append(f"@{attacker_card['username']} used {move_name} ({int(modifier*100)}% eff.) → {dmg} dmg!")
-        turn += 1
 
-    winner = card1["username"] if hp1 > 0 else (card2["username"] if hp2 > 0 else None)
-    return {"winner": winner, "hp1_end": max(0, hp1), "hp2_end": max(0, hp2), "log": battle_log}
+    # card1 attacks on even turns and card2 on odd ones, and no hit depends on
+    # an earlier one, so both sides' hits are rolled up front and the knockout
+    # is the first prefix sum that reaches the defender's HP.
+    n_turns = max_battle_turns(hp1, hp2)
+    powers1, mods1, labels1 = _attack_table(card1, card2)
+    powers2, mods2, labels2 = _attack_table(card2, card1)
+    picks1, dmg1 = _roll_hits(powers1, mods1, card2["defense"], (n_turns + 1) // 2)
+    picks2, dmg2 = _roll_hits(powers2, mods2, card1["defense"], n_turns // 2)
+    ko1 = int(np.searchsorted(np.cumsum(dmg1), hp2))  # card1's hit that drops card2
+    ko2 = int(np.searchsorted(np.cumsum(dmg2), hp1))  # card2's hit that drops card1
+    turns = min(2 * ko1 + 1, 2 * ko2 + 2, n_turns)
+    return _battle_result(card1, card2, hp1, hp2, turns, (labels1, picks1, dmg1), (labels2, picks2, dmg2))
+
+def simulate_batch(card_pairs: list[tuple[dict, dict]]) -> list[dict]:
+    """simulate_battle for many pairs (e.g. a round-robin), rolling every
+    battle's hits and finding every knockout with one set of array ops."""
+    if not card_pairs:
+        return []
+    hp1 = np.array([calculate_hp(card1) for card1, _ in card_pairs])
+    hp2 = np.array([calculate_hp(card2) for _, card2 in card_pairs])
+    n_turns = np.array([max_battle_turns(h1, h2) for h1, h2 in zip(hp1.tolist(), hp2.tolist())])
+    max_turns = int(n_turns.max())
+    tables1 = [_attack_table(card1, card2) for card1, card2 in card_pairs]
+    tables2 = [_attack_table(card2, card1) for card1, card2 in card_pairs]
+    def1 = np.array([[card1["defense"]] for card1, _ in card_pairs])
+    def2 = np.array([[card2["defense"]] for _, card2 in card_pairs])
+    b = len(card_pairs)
+    picks1, dmg1 = _roll_hits(np.stack([t[0] for t in tables1]), np.stack([t[1] for t in tables1]),
+                              def2, (b, (max_turns + 1) // 2))
+    picks2, dmg2 = _roll_hits(np.stack([t[0] for t in tables2]), np.stack([t[1] for t in tables2]),
+                              def1, (b, max_turns // 2))
+    # Damage is always >= MIN_DAMAGE, so each row's prefix sums strictly increase
+    # and counting those still short of the defender's HP gives the knockout hit.
+    ko1 = (np.cumsum(dmg1, axis=1) < hp2[:, None]).sum(axis=1)
+    ko2 = (np.cumsum(dmg2, axis=1) < hp1[:, None]).sum(axis=1)
+    turns = np.minimum.reduce([2 * ko1 + 1, 2 * ko2 + 2, n_turns]).tolist()
+    hp1, hp2 = hp1.tolist(), hp2.tolist()
+    return [
+        _battle_result(card1, card2, hp1[i], hp2[i], turns[i],
+                       (tables1[i][2], picks1[i], dmg1[i]), (tables2[i][2], picks2[i], dmg2[i]))
+        for i, (card1, card2) in enumerate(card_pairs)
+    ]
 
 
 # ---------- HTML replay ----------
-def save_battle_html(battle_id: str, context: dict):
-    html_path = f"battles/{battle_id}.html"
-    
-    # Use a generic image placeholder URL since we cannot include local files in a public URL
-    image_src = "https://placehold.co/400x200/ff6666/ffffff?text=BATTLE+REPLAY" 
-    
-    log_content = "\n".join([f"<p>{line}</p>" for line in context['log']])
-    
-    html = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Battle Replay: {battle_id}</title>
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <script src="https://cdn.tailwindcss.com"></script>
-        <style>
-            body {{
-                font-family: 'Inter', sans-serif;
-            }}
-            .card {{
-                box-shadow: 0 4px 6px -1px rgba(0, 0, 0, 0.1), 0 2px 4px -2px rgba(0, 0, 0, 0.1);
-            }}
-        </style>
-    </head>
-    <body class="bg-gray-900 text-white min-h-screen p-4 flex flex-col items-center">
-        <div class="max-w-xl w-full">
-            <h1 class="text-3xl font-bold mb-4 text-red-400">⚔️ Rizo Battle Replay</h1>
-            <div class="bg-gray-800 p-6 rounded-xl card mb-6">
-                <h2 class="text-2xl font-semibold mb-3">ID: {battle_id[:8]}...</h2>
-                <div class="flex flex-col sm:flex-row justify-around items-center mb-4 space-y-4 sm:space-y-0">
-                    <div class="text-center">
-                        <p class="text-xl font-bold text-blue-400">@{context['card1']['username']}</p>
-                        <p class="text-sm">HP: {context['hp1_end']}</p>
-                    </div>
-                    <p class="text-2xl font-extrabold text-red-500">VS</p>
-                    <div class="text-center">
-                        <p class="text-xl font-bold text-green-400">@{context['card2']['username']}</p>
-                        <p class="text-sm">HP: {context['hp2_end']}</p>
-                    </div>
-                </div>
-                
-                <p class="text-4xl font-black mt-4 mb-4">🏆 {context.get('winner_name','DRAW')}</p>
-            </div>
-
-            <div class="bg-gray-800 p-4 rounded-xl card">
-                <h2 class="text-xl font-semibold mb-2 text-yellow-300">Battle Log</h2>
-                <div class="h-64 overflow-y-scroll bg-gray-900 p-3 rounded-lg text-left text-sm space-y-1">
-                    {log_content}
-                </div>
-            </div>
-            <p class="mt-4 text-xs text-gray-500">
-                This page is running on the bot's server.
-            </p>
-        </div>
-    </body>
-    </html>
-    """
-    with open(html_path, "w", encoding="utf-8") as f:
-        f.write(html)
-    return html_path
+# Rendered replays are immutable and small, so keep the most recently used in
+# memory and serve /battle/{id} without touching the filesystem. Older ones
+# fall back to the file on disk.
+REPLAY_CACHE_SIZE = int(os.getenv("REPLAY_CACHE_SIZE", 1024))
+_BATTLE_HTML: LRUCache[str, bytes] = LRUCache(REPLAY_CACHE_SIZE)  # battle_id -> encoded page
+
+def load_battle_cache():
+    with _DB_LOCK:
+        rows = DB.execute(
+            "SELECT id, html_path FROM battles ORDER BY timestamp DESC LIMIT ?", (REPLAY_CACHE_SIZE,)
+        ).fetchall()
+    for battle_id, html_path in reversed(rows):  # Oldest first, so the newest end up most recent
+        try:
+            with open(html_path, "rb") as f:
+                _BATTLE_HTML[battle_id] = f.read()
+        except OSError as e:
+            log.warning(f"Could not preload replay {battle_id}: {e}")
+
+# Page shell read and compiled once at import; ${field} placeholders leave the
+# CSS braces in the file alone
+with open(os.path.join("templates", "battle.html"), encoding="utf-8") as _f:
+    _BATTLE_TEMPLATE = string.Template(_f.read()).substitute
+
+def battle_html_path(battle_id: str) -> str:
+    return f"{BATTLES_DIR}/{battle_id}.html"
+
+def render_battle_html(battle_id: str, context: dict) -> bytes:
+    """Render a replay page and cache it for battle_page before it reaches disk."""
+    html = _BATTLE_TEMPLATE({
+        "battle_id": battle_id,
+        "short_id": battle_id[:8],
+        "username1": context['card1']['username'],
+        "hp1_end": context['hp1_end'],
+        "username2": context['card2']['username'],
+        "hp2_end": context['hp2_end'],
+        "winner_name": context.get('winner_name', 'DRAW'),
+        "log_content": "".join(f"<p>{line}</p>" for line in context['log']),
+    })
+    body = html.encode("utf-8")
+    _BATTLE_HTML[battle_id] = body
+    return body
+
+def save_battle_html(html_path: str, body: bytes):
+    with open(html_path, "wb") as f:
+        f.write(body)
+
+# Battle rows are queued and written by _battle_writer, so a burst of battles
+# shares one transaction (and one WAL sync) instead of committing each row.
+# A batch is written once DB_BATCH_SIZE rows are queued or DB_BATCH_WINDOW
+# seconds after its first row, whichever comes first.
+DB_BATCH_SIZE = 16
+DB_BATCH_WINDOW = 0.2
+_battle_rows: asyncio.Queue[tuple] = asyncio.Queue()
+_battle_batch_full = asyncio.Event()
+_battle_writer_task: Optional[asyncio.Task] = None
 
 def persist_battle_record(battle_id: str, challenger_username: str, challenger_stats: dict,
                           opponent_username: str, opponent_stats: dict, winner: Optional[str], html_path: str, hp1_end: int, hp2_end: int):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO battles (id,timestamp,challenger_username,challenger_stats,opponent_username,opponent_stats,winner,html_path) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-        (battle_id, datetime.utcnow().isoformat(), challenger_username, json.dumps(challenger_stats),
-         opponent_username, json.dumps(opponent_stats), winner or "", html_path)
+    _battle_rows.put_nowait(
+        # Stats are stored as UTF-8 JSON bytes (BLOB); rows from older versions hold TEXT,
+        # and json_loads reads both
+        (battle_id, datetime.utcnow().isoformat(), challenger_username, json_dumpb(challenger_stats),
+         opponent_username, json_dumpb(opponent_stats), winner or "", html_path)
     )
-    conn.commit()
-    conn.close()
+    # The writer already holds the batch's first row once it is waiting
+    if _battle_rows.qsize() >= DB_BATCH_SIZE - 1:
+        _battle_batch_full.set()
+
+DB_WRITE_RETRIES = 3
+
+def write_battle_rows(rows: list[tuple]):
+    with tx() as db:
+        db.executemany(_INSERT_SQL, rows)
+
+def save_battle_rows(rows: list[tuple]):
+    """Write a batch, retrying transient failures (a locked or busy database).
+
+    If the batch still can't be written, each row is tried on its own so one
+    bad row doesn't take the rest with it; a row that fails even then is
+    logged in full so it can be recovered by hand.
+    """
+    for attempt in range(1, DB_WRITE_RETRIES + 1):
+        try:
+            write_battle_rows(rows)
+            return
+        except sqlite3.OperationalError as e:
+            log.warning(f"Battle batch write failed (attempt {attempt}/{DB_WRITE_RETRIES}): {e}")
+            time.sleep(0.5 * attempt)
+        except sqlite3.Error as e:
+            log.warning(f"Battle batch write failed, retrying row by row: {e}")
+            break
+    for row in rows:
+        try:
+            write_battle_rows([row])
+        except sqlite3.Error as e:
+            log.error(f"Could not persist battle record {row[0]}: {e}; row: {row!r}")
+
+def _drain_battle_rows(limit: Optional[int] = None) -> list[tuple]:
+    rows = []
+    while not _battle_rows.empty() and (limit is None or len(rows) < limit):
+        rows.append(_battle_rows.get_nowait())
+    return rows
+
+_STOP_WRITER = None  # Queued by stop_battle_writer; rows ahead of it are still written
+
+async def _battle_writer():
+    # Never cancelled: a batch taken off the queue lives only in this frame, so
+    # shutdown asks the writer to finish instead.
+    while True:
+        rows = [await _battle_rows.get()]
+        if rows[0] is not _STOP_WRITER:
+            try:
+                await asyncio.wait_for(_battle_batch_full.wait(), DB_BATCH_WINDOW)
+            except asyncio.TimeoutError:
+                pass
+            _battle_batch_full.clear()
+            rows += _drain_battle_rows(DB_BATCH_SIZE - 1)
+        stopping = _STOP_WRITER in rows
+        rows = [row for row in rows if row is not _STOP_WRITER]
+        if rows:
+            await asyncio.to_thread(save_battle_rows, rows)
+        if stopping:
+            return
+
+def start_battle_writer():
+    global _battle_writer_task
+    _battle_writer_task = asyncio.create_task(_battle_writer())
+
+async def stop_battle_writer():
+    """Let the writer finish its current batch, then flush anything still queued."""
+    global _battle_writer_task
+    if _battle_writer_task:
+        _battle_rows.put_nowait(_STOP_WRITER)
+        _battle_batch_full.set()  # Don't sit out the rest of the batch window
+        await _battle_writer_task
+        _battle_writer_task = None
+    rows = _drain_battle_rows()
+    if rows:
+        await asyncio.to_thread(save_battle_rows, rows)
 
 # ---------- Telegram handlers ----------
 async def cmd_battle(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -273,7 +893,7 @@ async def cmd_challenge(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
         
     opponent_username = context.args[0].lstrip("@").strip().lower()
-    pending_challenges[challenger.id] = opponent_username
+    await store_challenge(challenger.id, opponent_username)
     await update.message.reply_text(f"⚔️ @{challenger.username} challenged @{opponent_username}! Upload cards now.")
 
 async def handler_card_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -305,87 +925,80 @@ async def handler_card_upload(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("File size limit exceeded (5MB). Please upload a smaller image.")
         return
 
-    try:
-        file_bytes = await file_obj.download_as_bytearray()
-    except Exception as e:
-        log.error(f"Error downloading file: {e}")
-        await update.message.reply_text("Failed to download the file. Please try again.")
-        return
+    async with user_state_lock(user_id):
+        save_path = f"{CARDS_DIR}/{username}.png"
+        buf = io.BytesIO()
+        try:
+            await file_obj.download_to_memory(buf)
+        except Exception as e:
+            log.error(f"Error downloading file: {e}")
+            await update.message.reply_text("Failed to download the file. Please try again.")
+            return
 
-    os.makedirs("cards", exist_ok=True)
-    save_path = f"cards/{username}.png"
-    try:
-        with open(save_path, "wb") as f:
-            f.write(file_bytes)
+        try:
+            digest = await asyncio.to_thread(save_card_file, save_path, buf.getbuffer())
+            parsed = await read_card_stats(save_path, digest, buf)
+        except Exception as e:
+            log.warning(f"Error processing OCR/File save: {e}. Using default stats.")
+            parsed = {"hp":100,"defense":50,"serial":1000,"attack1_name":"Basic Strike","attack1_power":30,"attack2_name":"Heavy Blow","attack2_power":40,"attack1_elem":ELEM_NORMAL,"attack2_elem":ELEM_NORMAL}
 
-        ocr_text = ocr_text_from_bytes(file_bytes)
-        parsed = parse_stats_from_text(ocr_text)
-    except Exception as e:
-        log.warning(f"Error processing OCR/File save: {e}. Using default stats.")
-        parsed = {"hp":100,"defense":50,"serial":1000,"attack1_name":"Basic Strike","attack1_power":30,"attack2_name":"Heavy Blow","attack2_power":40}
+        card = {"username":username, "user_id":user_id, "path":save_path, **parsed}
+        await store_card(card)
+        await update.message.reply_text(f"✅ @{username}'s card received — Base HP: {card['hp']} (Calculated HP: {calculate_hp(card)})")
 
-    card = {"username":username, "user_id":user_id, "path":save_path, **parsed}
-    uploaded_cards[user_id] = card
-    await update.message.reply_text(f"✅ @{username}'s card received — Base HP: {card['hp']} (Calculated HP: {calculate_hp(card)})")
+        # Trigger battle if both uploaded
+        claimed = await claim_battle(user_id, username)
+        if not claimed:
+            return
+        card1, card2 = claimed
 
-    # Trigger battle if both uploaded
-    triggered_pair = None
-    
-    # Case 1: Challenger uploads card after challenging
-    if user_id in pending_challenges:
-        opp_name = pending_challenges[user_id]
-        opp_id = next((uid for uid,c in uploaded_cards.items() if c["username"]==opp_name), None)
-        if opp_id and opp_id != user_id: # Ensure user isn't challenging/fighting self
-             triggered_pair = (user_id, opp_id)
-             
-    # Case 2: Opponent uploads card matching an existing challenge
-    if not triggered_pair:
-        for challenger_id, opp_name in pending_challenges.items():
-            if username==opp_name and challenger_id in uploaded_cards and challenger_id != user_id:
-                triggered_pair = (challenger_id, user_id)
-                break
+    await run_battle(context, update.effective_chat.id, card1, card2)
 
-    if triggered_pair:
-        c1_id,c2_id = triggered_pair
-        card1, card2 = uploaded_cards[c1_id], uploaded_cards[c2_id]
-        
-        # Simulate and get results
-        result = simulate_battle(card1, card2)
-        battle_id = str(uuid.uuid4())
-        
-        # Save HTML replay
-        html_context = {
-            "winner_name": result["winner"] or "Tie",
-            "card1": card1, "card2": card2,
-            "hp1_end": result["hp1_end"], "hp2_end": result["hp2_end"],
-            "log": result["log"]
-        }
-        html_path = save_battle_html(battle_id, html_context)
-        
-        # Persist to database
-        persist_battle_record(battle_id, card1["username"], card1, card2["username"], card2, 
-                              result["winner"], html_path, result["hp1_end"], result["hp2_end"])
+async def run_battle(context: ContextTypes.DEFAULT_TYPE, chat_id: int, card1: dict, card2: dict):
+    # Simulate and get results
+    result = simulate_battle(card1, card2)
+    battle_id = str(uuid.uuid4())
+    
+    # Save HTML replay
+    html_context = {
+        "winner_name": result["winner"] or "Tie",
+        "card1": card1, "card2": card2,
+        "hp1_end": result["hp1_end"], "hp2_end": result["hp2_end"],
+        "log": result["log"]
+    }
+    html_body = render_battle_html(battle_id, html_context)
+    html_path = battle_html_path(battle_id)
+    
+    # Persist to database (queued; written in batches by _battle_writer)
+    persist_battle_record(battle_id, card1["username"], card1, card2["username"], card2,
+                          result["winner"], html_path, result["hp1_end"], result["hp2_end"])
 
-        # Send notification
-        replay_url = f"{RENDER_EXTERNAL_URL}/battle/{battle_id}"
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🎬 View Battle Replay", url=replay_url)]])
-        
-        winner_text = f"🏆 Winner: @{result['winner']}" if result['winner'] else "🤝 It's a tie!"
-        summary_text = f"⚔️ Battle complete!\n{winner_text}\n"
-        summary_text += f"@{card1['username']} HP: {result['hp1_end']} vs @{card2['username']} HP: {result['hp2_end']}\n"
-        summary_text += "\n\n**Log Snippet:**\n"
-        summary_text += "\n".join(result["log"][:3]) + ("\n...(see replay for full log)" if len(result["log"])>3 else "")
-        
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
+    # Send notification
+    replay_url = f"{RENDER_EXTERNAL_URL}/battle/{battle_id}"
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🎬 View Battle Replay", url=replay_url)]])
+    
+    parts = [
+        "⚔️ Battle complete!",
+        f"🏆 Winner: @{result['winner']}" if result['winner'] else "🤝 It's a tie!",
+        f"@{card1['username']} HP: {result['hp1_end']} vs @{card2['username']} HP: {result['hp2_end']}",
+        "",
+        "",
+        "**Log Snippet:**",
+    ]
+    parts.extend(result["log"][:3])
+    if len(result["log"]) > 3:
+        parts.append("...(see replay for full log)")
+    summary_text = "\n".join(parts)
+    
+    # The replay is already served from memory, so the notification doesn't wait on the file write
+    await asyncio.gather(
+        asyncio.to_thread(save_battle_html, html_path, html_body),
+        context.bot.send_message(
+            chat_id=chat_id,
             text=summary_text, 
             reply_markup=keyboard
-        )
-
-        # Clean up
-        uploaded_cards.pop(c1_id, None)
-        uploaded_cards.pop(c2_id, None)
-        pending_challenges.pop(c1_id, None)
+        ),
+    )
 
 
 # ---------- FastAPI routes ----------
@@ -393,17 +1006,39 @@ async def handler_card_upload(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def root():
     return {"status": "ok", "service": "Rizo Battle Bot"}
 
+_IMMUTABLE_HEADERS = {"Cache-Control": "public, max-age=31536000, immutable"}
+
 @app.get("/battle/{battle_id}", response_class=HTMLResponse)
 async def battle_page(battle_id: str):
-    battle_file = f"battles/{battle_id}.html"
+    body = _BATTLE_HTML.get(battle_id)
+    if body is not None:
+        # Recorded replays never change, so browsers and CDNs can keep them forever
+        return Response(content=body, media_type="text/html", headers=_IMMUTABLE_HEADERS)
+    # Replays not recorded in the DB (e.g. hand-placed demos) still come from disk
+    battle_file = battle_html_path(battle_id)
     if os.path.exists(battle_file):
         return FileResponse(battle_file, media_type="text/html")
     return HTMLResponse("<h1 class='text-white bg-gray-900'>Battle not found.</h1>", status_code=404)
 
+# Every Telegram update gets this same acknowledgement, so encode it once
+# instead of JSON-serializing a dict per request.
+_WEBHOOK_OK = b'{"ok":true}'
+
+# The only update kinds (and message contents) our command/photo handlers act
+# on. Anything else would be built into an Update by de_json just to be dropped.
+_HANDLED_UPDATE_TYPES = ["message", "edited_message", "channel_post", "edited_channel_post"]
+_HANDLED_MESSAGE_KEYS = ("text", "photo", "document")
+
+def is_handled_update(data: dict) -> bool:
+    message = next((data[k] for k in _HANDLED_UPDATE_TYPES if k in data), None)
+    return message is not None and any(k in message for k in _HANDLED_MESSAGE_KEYS)
+
 # --- FIX: Match the new, simpler WEBHOOK_PATH ---
 @app.post(WEBHOOK_PATH)
 async def telegram_webhook(req: Request):
-    data = await req.json()
+    data = json_loads(await req.body())
+    if not is_handled_update(data):
+        return Response(content=_WEBHOOK_OK, media_type="application/json")
     
     if not telegram_app or not telegram_app.bot:
         log.error("Telegram Application is not initialized.")
@@ -411,7 +1046,7 @@ async def telegram_webhook(req: Request):
         
     update = Update.de_json(data, telegram_app.bot)
     await telegram_app.process_update(update)
-    return {"ok": True}
+    return Response(content=_WEBHOOK_OK, media_type="application/json")
 # --------------------------------------------------------
 
 # ---------- Telegram app startup ----------
@@ -420,13 +1055,21 @@ telegram_app: Optional[Application] = None
 @app.on_event("startup")
 async def on_startup():
     global telegram_app
+
+    load_battle_cache()
+    start_battle_writer()
+    await warm_ocr_engines()
+    # Pillow-SIMD builds carry a ".postN" suffix
+    log.info(f"Using Pillow {PIL_VERSION}")
     
     if not BOT_TOKEN or not RENDER_EXTERNAL_URL:
         log.warning("Startup aborted: BOT_TOKEN or RENDER_EXTERNAL_URL missing.")
         return
         
     log.info("Starting Telegram bot initialization...")
-    telegram_app = ApplicationBuilder().token(BOT_TOKEN).build()
+    # Card downloads go through the bot's own pooled httpx client, so every
+    # get_file/download_to_memory reuses its keep-alive connections.
+    telegram_app = ApplicationBuilder().token(BOT_TOKEN).http_version(TELEGRAM_HTTP_VERSION).build()
     
     # Add handlers
     telegram_app.add_handler(CommandHandler("battle", cmd_battle))
@@ -436,17 +1079,37 @@ async def on_startup():
 
     await telegram_app.initialize()
     
-    # Set the webhook to the external URL
+    # Set the webhook to the external URL. Every uvicorn worker runs this, so it
+    # only registers when Telegram's settings differ and never drops updates
+    # already queued for the workers that are up.
     try:
-        await telegram_app.bot.delete_webhook(drop_pending_updates=True)
-        await telegram_app.bot.set_webhook(WEBHOOK_URL)
-        log.info(f"✅ Webhook set successfully to {WEBHOOK_URL}")
+        info = await telegram_app.bot.get_webhook_info()
+        if info.url == WEBHOOK_URL and set(info.allowed_updates or ()) == set(_HANDLED_UPDATE_TYPES):
+            log.info(f"Webhook already set to {WEBHOOK_URL}")
+        else:
+            await telegram_app.bot.set_webhook(WEBHOOK_URL, allowed_updates=_HANDLED_UPDATE_TYPES)
+            log.info(f"✅ Webhook set successfully to {WEBHOOK_URL}")
     except Exception as e:
         log.error(f"Failed to set webhook: {e}")
         pass 
 
 @app.on_event("shutdown")
 async def on_shutdown():
+    # Persist queued battles before anything that can fail over the network
+    try:
+        await stop_battle_writer()
+    finally:
+        close_db()
+    # The webhook is left registered: other workers (or this one, once
+    # restarted) keep serving it.
     if telegram_app:
-        log.info("Shutting down and deleting webhook...")
-        await telegram_app.bot.delete_webhook()
+        log.info("Shutting down Telegram application...")
+        await telegram_app.shutdown()
+    if _redis is not None:
+        await _redis.aclose()
+    _OCR_POOL.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run("app:app", host="0.0.0.0", port=PORT, loop="uvloop", http="httptools")